@@ -1,10 +1,27 @@
 import streamlit as st
 from google import genai
+from google.genai import types
 from google.genai.errors import APIError
+import httpx
 import pandas as pd
-import io
+import numpy as np
+import asyncio
 import json
+import math
+import os
 import re
+import unicodedata
+import hashlib
+import ijson
+from pydantic import BaseModel, Field, ValidationError, create_model
+from typing import Literal
+import sqlite3
+import threading
+import queue
+import time
+import random
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, wait
 
 # --- 1. ข้อมูลคงที่ (Constants) ---
 AIRCRAFT_DATA = {
@@ -17,10 +34,75 @@ AIRCRAFT_DATA = {
     "B777-300ER": {"eco": 315, "bc": 40, "first": 8, "fuel_cost": 2080, "range_km": 13650},
 }
 
+# ลำดับรุ่นเครื่องบินคงที่ คำนวณครั้งเดียวตอนโหลดโมดูล
+AIRCRAFT_MODELS = tuple(AIRCRAFT_DATA)
+
+# มุมมองแบบตาราง (หนึ่งคอลัมน์ต่อคุณสมบัติ) สำหรับกรองรุ่นเครื่องบินแบบ vectorized
+AIRCRAFT_DF = pd.DataFrame.from_dict(AIRCRAFT_DATA, orient="index")
+
+# คอลัมน์ของตารางประเมินเครื่องบิน (11 คอลัมน์ ตามลำดับข้อมูลที่ Gemini ส่งคืน) และชนิดข้อมูลของคอลัมน์ตัวเลข
+EVAL_COLUMNS = [
+    "ชื่อรุ่นเครื่องบิน", "พิสัยการบิน (กม.)", "จำนวนที่นั่ง (eco/bc/first)", 
+    "อัตราสิ้นเปลือง (USD/hr)", "คาดการณ์ผู้โดยสารขาไป (eco/bc/first)", 
+    "คาดการณ์ผู้โดยสารขากลับ (eco/bc/first)", "ความถี่เที่ยวบิน (ไป+กลับ)/สัปดาห์", 
+    "เวลา Departure จาก BKK", "เวลา Departure จากปลายทาง", 
+    "ความเหมาะสม (ดาว)", "สรุปสาเหตุ"
+]
+# คอลัมน์ที่แสดงในตาราง (ใช้คอลัมน์ดาวที่จัดรูปแบบแล้วแทนคะแนนดิบ)
+COLUMNS_TO_SHOW = [
+    "ชื่อรุ่นเครื่องบิน", "พิสัยการบิน (กม.)", "จำนวนที่นั่ง (eco/bc/first)", 
+    "อัตราสิ้นเปลือง (USD/hr)", "คาดการณ์ผู้โดยสารขาไป (eco/bc/first)", 
+    "คาดการณ์ผู้โดยสารขากลับ (eco/bc/first)", "ความถี่เที่ยวบิน (ไป+กลับ)/สัปดาห์", 
+    "เวลา Departure จาก BKK", "เวลา Departure จากปลายทาง", 
+    "ความเหมาะสม (ดาว) Format", "สรุปสาเหตุ"
+]
+# ชนิดข้อมูลแบบ nullable: ค่า "N/A" ของแถวที่ผิดพลาดจะกลายเป็นค่าว่าง คอลัมน์จึงยังเป็นตัวเลขล้วน
+EVAL_DTYPES = {
+    "พิสัยการบิน (กม.)": "Int32",
+    "อัตราสิ้นเปลือง (USD/hr)": "Int32",
+    "ความถี่เที่ยวบิน (ไป+กลับ)/สัปดาห์": "Int16",
+    "ความเหมาะสม (ดาว)": "Float32",
+}
+
 CONTINENTS = [
     "Domestic", "Africa", "Antarctica", "Asia", "Europe", "North America", "Oceania", "South America"
 ]
 
+# โมเดลเล็ก/เร็วสำหรับคำถามข้อเท็จจริงสั้นๆ และโมเดลหลักสำหรับการวิเคราะห์เครื่องบิน 11 คอลัมน์
+FAST_MODEL = "gemini-2.5-flash-lite"
+ANALYSIS_MODEL = "gemini-2.5-flash"
+
+# Gemini Batch Mode (ทางเลือกใน Sidebar): ราคาถูกกว่าแต่ต้องรอ Job เสร็จ
+BATCH_POLL_SECONDS = 10
+BATCH_TIMEOUT_SECONDS = 15 * 60
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# ความถี่ (วินาที) ในการอัปเดตความคืบหน้าระหว่างรอคำตอบแบบสตรีมรายรุ่น
+STREAM_POLL_SECONDS = 0.25
+
+# จำนวนตารางประเมิน (เส้นทางล่าสุด) ที่เก็บไว้ใน session state ต่อ Session
+EVAL_DF_CACHE_SIZE = 5
+
+# ลองเรียก Gemini ใหม่เมื่อเจอข้อผิดพลาดชั่วคราว (เกิน Quota / Server ขัดข้อง) แบบ exponential backoff
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+MAX_RETRY_ATTEMPTS = 4
+
+# สถิติแคชที่แสดงใน Sidebar (hit = ตอบจากข้อมูลในเครื่อง/แคช, miss = ต้องเรียก Gemini)
+# eval_* นับทุกครั้งที่ค้นผลประเมินเครื่องบินในแคชบนดิสก์ (รายรุ่น หรือ Request รวมหลายรุ่น)
+CACHE_STAT_KEYS = ("cons_hits", "cons_miss", "dist_hits", "dist_miss", "eval_hits", "eval_miss")
+
+# จำนวน Request ไป Gemini ที่ส่งพร้อมกันได้สูงสุด (ทั้ง Process) เพื่อไม่ให้ชน Quota ต่อนาที
+# ปรับได้ผ่าน Environment Variable GEMINI_MAX_IN_FLIGHT
+DEFAULT_MAX_IN_FLIGHT = 4
+MAX_IN_FLIGHT = max(1, int(os.environ.get("GEMINI_MAX_IN_FLIGHT", DEFAULT_MAX_IN_FLIGHT)))
+
+# Regex สำหรับดึงตัวเลขระยะทางจากข้อความ (คอมไพล์ครั้งเดียว รองรับตัวเลขที่มีจุลภาค เช่น 9,540)
+_DIGITS_RE = re.compile(r"(\d[\d,]*)")
+
+# รูปแบบ Input ที่เป็นไปได้ ตรวจในเครื่องก่อนเสียเวลาถาม Gemini
+_IATA_RE = re.compile(r"^[A-Z]{3}$")
+_CITY_RE = re.compile(r"^[^\W\d_](?:[^\W\d_]|[ .'\-])+$")
+
 # --- 2. การตั้งค่าหน้าเว็บและ Sidebar ---
 st.set_page_config(
     page_title="✈️ Airline Route Calculator (Gemini Powered)",
@@ -40,58 +122,508 @@ with st.sidebar:
         help="API Key สำหรับเรียกใช้ Google Gemini."
     )
 
-    if 'gemini_api_key' not in st.session_state or st.session_state.gemini_api_key != gemini_api_key:
-        st.session_state.gemini_api_key = gemini_api_key
+    if 'cache_stats' not in st.session_state:
+        st.session_state.cache_stats = dict.fromkeys(CACHE_STAT_KEYS, 0)
+
+    st.session_state.gemini_api_key = gemini_api_key
+
+    st.checkbox(
+        "**Batch mode** (ถูกกว่า แต่ช้ากว่า)",
+        key="batch_mode",
+        help="ส่งการประเมินเครื่องบินเป็น Gemini Batch Job (ลดค่าใช้จ่ายประมาณ 50% แต่อาจต้องรอหลายนาที)"
+    )
 
 # --- 3. ฟังก์ชันจัดการ Gemini Client (ใช้ @st.cache_resource) ---
 
 @st.cache_resource(show_spinner="กำลังตั้งค่า Gemini Client...")
-def get_gemini_client(api_key: str):
-    """สร้างและแคชออบเจกต์ Gemini Client"""
+def get_gemini_client(api_key: str, loop_id: int):
+    """
+    สร้างและแคชออบเจกต์ Gemini Client แยกตาม API Key และ event loop ถาวร (loop_id)
+    httpx.AsyncClient ผูกกับ loop ที่ใช้ครั้งแรก เมื่อ loop ถูกสร้างใหม่ (เช่นหลัง Clear caches) จึงต้องได้ Client ใหม่ด้วย
+    """
     if not api_key:
         return None
     try:
-        return genai.Client(api_key=api_key)
+        # ใช้ httpx.AsyncClient (HTTP/2) ตัวเดียวตลอดอายุ Client เพื่อใช้ Connection ซ้ำ
+        # และ multiplex Request ที่ยิงพร้อมกันบน Connection เดียว
+        return genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(
+                httpx_async_client=httpx.AsyncClient(
+                    http2=True,
+                    limits=httpx.Limits(max_keepalive_connections=16),
+                ),
+            ),
+        )
     except Exception as e:
         st.error(f"เกิดข้อผิดพลาดในการตั้งค่า Gemini Client: {e}")
         return None
 
+@st.cache_resource
+def _get_event_loop():
+    """
+    Event loop ถาวรใน background thread สำหรับงาน async ของ Gemini ทั้งหมด
+    (httpx.AsyncClient ผูกกับ loop ที่ใช้ครั้งแรก จึงต้องใช้ loop เดียวตลอด)
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="gemini-event-loop", daemon=True).start()
+    return loop
+
+def _submit_async(coro):
+    """ส่ง coroutine ไปรันบน event loop ถาวร คืน concurrent.futures.Future (ห้ามเรียก st.* ใน coroutine)"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop())
+
+class Admission:
+    """
+    ตัวควบคุมการรับ Request เข้า (admission control) ด้วย asyncio.Condition:
+    ให้มี Request ที่กำลังรอ Gemini (in-flight) ไม่เกิน c_max
+    """
+
+    def __init__(self, c_max: int):
+        self.active = 0
+        self.c_max = c_max
+        self.cond = asyncio.Condition()
+
+    async def run(self, coro):
+        """รอจนมีช่องว่าง แล้วจึง await coroutine ที่ส่งมา"""
+        try:
+            async with self.cond:
+                await self.cond.wait_for(lambda: self.active < self.c_max)
+                self.active += 1
+        except BaseException:
+            coro.close()
+            raise
+        try:
+            return await coro
+        finally:
+            async with self.cond:
+                self.active -= 1
+                self.cond.notify(1)
+
+@st.cache_resource
+def _get_admission(loop_id: int):
+    """Admission ตัวเดียวที่ใช้ร่วมกันทุก Session (แยกตาม event loop ถาวร เพราะ asyncio.Condition ผูกกับ loop)"""
+    return Admission(MAX_IN_FLIGHT)
+
+async def call_with_retry(make_call):
+    """
+    await make_call() (ฟังก์ชันที่คืน coroutine ใหม่ทุกครั้ง) และลองใหม่แบบ exponential backoff + jitter
+    เมื่อ Gemini ตอบ APIError ชั่วคราว (429/5xx) ข้อผิดพลาดอื่นหรือครบจำนวนครั้งจะส่งต่อให้ผู้เรียก
+    """
+    for attempt in range(MAX_RETRY_ATTEMPTS):
+        try:
+            return await make_call()
+        except APIError as e:
+            if e.code not in RETRYABLE_STATUS_CODES or attempt == MAX_RETRY_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(2 ** attempt + random.random())
+
+def _submit_gemini(make_call):
+    """
+    ส่งการเรียก Gemini ไปรันบน event loop ถาวร โดยผ่าน Admission และลองใหม่เมื่อเจอข้อผิดพลาดชั่วคราว
+    (ระหว่างรอ backoff จะคืนช่องของ Admission ให้ Request อื่นก่อน)
+    """
+    admission = _get_admission(id(_get_event_loop()))
+    return _submit_async(call_with_retry(lambda: admission.run(make_call())))
+
 def _get_active_client():
-    """ดึง Client จาก cache resource"""
-    return get_gemini_client(st.session_state.get('gemini_api_key', ''))
+    """Client ของ API Key ใน session state ที่ผูกกับ event loop ถาวรตัวปัจจุบัน"""
+    return get_gemini_client(st.session_state.get('gemini_api_key', ''), id(_get_event_loop()))
 
 client = _get_active_client()
+
 is_gemini_ready = client is not None and st.session_state.get('gemini_api_key', '')
 
+# --- ข้อมูลสนามบินแบบ Offline (airports.csv) ---
+
+AIRPORTS_CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "airports.csv")
+ORIGIN_IATA = "BKK"
+EARTH_RADIUS_KM = 6371.0088
+
+@st.cache_resource
+def load_airports():
+    """โหลด airports.csv ครั้งเดียวเป็น dict: IATA -> (city, country, continent, lat, lon)"""
+    try:
+        df = pd.read_csv(AIRPORTS_CSV_PATH, keep_default_na=False, dtype={"lat": float, "lon": float})
+    except (OSError, ValueError):
+        return {}
+    return {
+        row.iata: (row.city, row.country, row.continent, row.lat, row.lon)
+        for row in df.itertuples(index=False)
+    }
+
+def _normalize_city(name: str) -> str:
+    """ตัดวรรณยุกต์/สัญลักษณ์และแปลงเป็นตัวพิมพ์เล็ก เพื่อเทียบชื่อเมือง"""
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", name.lower()).split())
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    """ระยะทาง Great Circle (กม.) ระหว่างสองพิกัด"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def _local_consistency(iata_code: str, city_name: str, continent: str):
+    """
+    ตรวจสอบ IATA/City/Continent จากข้อมูลในเครื่อง คืน "PASS" เมื่อตรงกัน
+    คืน None เมื่อไม่พบ IATA หรือไม่ตรงกันทั้งชื่อ (ชื่อเมืองอาจมีหลายแบบ จึงให้ Gemini ตัดสินต่อ)
+    """
+    airport = load_airports().get(iata_code.upper())
+    if airport is None:
+        return None
+    local_city, country, local_continent, _, _ = airport
+
+    if continent == "Domestic":
+        continent_ok = country == "TH"
+    else:
+        continent_ok = continent == local_continent
+
+    # ต้องตรงทั้งชื่อ (หลัง normalize) กับชื่อเต็ม หรือกับชื่อใดชื่อหนึ่งที่คั่นด้วย "/" หรือ "," เช่น "Arnavutköy, Istanbul"
+    # ชื่อบางส่วน (เช่น "Don" กับ London) จะไม่ผ่าน และถูกส่งต่อให้ Gemini ตรวจ
+    city = _normalize_city(city_name)
+    local_names = {_normalize_city(name) for name in [local_city, *re.split(r"[/,]", local_city)]}
+    city_ok = bool(city) and city in local_names
+
+    return "PASS" if continent_ok and city_ok else None
+
+def _local_distance(destination_code: str):
+    """ระยะทางบินจาก BKK จากพิกัดในเครื่อง (คืน None ถ้าไม่พบสนามบิน)"""
+    airports = load_airports()
+    origin = airports.get(ORIGIN_IATA)
+    destination = airports.get(destination_code.upper())
+    if origin is None or destination is None:
+        return None
+    return int(round(_haversine_km(origin[3], origin[4], destination[3], destination[4])))
+
 # --- 4. ฟังก์ชันเรียกใช้ Gemini API ---
 
-@st.cache_data(show_spinner="กำลังตรวจสอบความสอดคล้องของข้อมูล...")
-def check_airport_consistency(iata_code: str, city_name: str, continent: str):
-    client = _get_active_client()
-    if client is None:
-        return "API_ERROR: Gemini Client ไม่พร้อมใช้งาน"
+# แคชผลลัพธ์ Gemini ลงดิสก์ (SQLite) เพื่อให้อยู่รอดข้ามการรีสตาร์ต/Deploy ซึ่ง @st.cache_data ทำไม่ได้
+GEMINI_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gemini_cache.db")
+GEMINI_CACHE_TTL = 30 * 24 * 60 * 60  # วินาที
+
+_disk_cache_lock = threading.Lock()
+
+@st.cache_resource
+def _get_disk_cache_db():
+    """เปิด (และแคช) การเชื่อมต่อ SQLite พร้อมลบรายการที่หมดอายุแล้ว"""
+    conn = sqlite3.connect(GEMINI_CACHE_PATH, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS gemini_cache (hash TEXT PRIMARY KEY, value BLOB, created REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS lookup_cache (key TEXT PRIMARY KEY, value TEXT, model TEXT, created REAL)")
+    conn.execute("DELETE FROM gemini_cache WHERE created <= ?", (time.time() - GEMINI_CACHE_TTL,))
+    conn.execute("DELETE FROM lookup_cache WHERE created <= ?", (time.time() - GEMINI_CACHE_TTL,))
+    conn.commit()
+    return conn
+
+def _disk_cache_digest(namespace: str, key: str) -> str:
+    return hashlib.sha256(f"{namespace}\n{key}".encode()).hexdigest()
+
+def _disk_cache_get(namespace: str, key: str):
+    """คืนค่าจากแคชบนดิสก์ถ้ามีและยังไม่หมดอายุ (ไม่เช่นนั้นคืน None)"""
+    conn = _get_disk_cache_db()
+    with _disk_cache_lock:
+        row = conn.execute(
+            "SELECT value FROM gemini_cache WHERE hash = ? AND created > ?",
+            (_disk_cache_digest(namespace, key), time.time() - GEMINI_CACHE_TTL),
+        ).fetchone()
+    return row[0] if row is not None else None
 
+def _disk_cache_put(namespace: str, key: str, value):
+    conn = _get_disk_cache_db()
+    with _disk_cache_lock:
+        conn.execute(
+            "INSERT OR REPLACE INTO gemini_cache (hash, value, created) VALUES (?, ?, ?)",
+            (_disk_cache_digest(namespace, key), value, time.time()),
+        )
+        conn.commit()
+
+def _disk_cache(namespace: str, key: str, producer, validate):
+    """
+    คืนค่าจากแคชบนดิสก์ถ้ามี ยังไม่หมดอายุ และผ่าน validate() ไม่เช่นนั้นเรียก producer()
+    และบันทึกผลเฉพาะเมื่อผ่าน validate() (คำตอบว่าง/ผิดรูปแบบจะไม่ถูกเก็บไว้ใช้ซ้ำ 30 วัน)
+    """
+    value = _disk_cache_get(namespace, key)
+    if value is not None and validate(value):
+        return value
+
+    value = producer()
+    if validate(value):
+        _disk_cache_put(namespace, key, value)
+    return value
+
+def _lookup_cache_get(key: str, models):
+    """
+    คืนผลลัพธ์สุดท้ายที่เคยคำนวณไว้ของคีย์ เช่น "dist:LHR" (ไม่เช่นนั้นคืน None)
+    รายการที่บันทึกโดยโมเดลอื่นนอกจาก models ถือว่าใช้ไม่ได้ (เปลี่ยนโมเดลแล้วต้องถามใหม่)
+    """
+    conn = _get_disk_cache_db()
+    with _disk_cache_lock:
+        row = conn.execute(
+            "SELECT value, model FROM lookup_cache WHERE key = ? AND created > ?",
+            (key, time.time() - GEMINI_CACHE_TTL),
+        ).fetchone()
+    if row is None or row[1] not in models:
+        return None
+    return json.loads(row[0])
+
+def _lookup_cache_put(key: str, model: str, value):
+    """บันทึกผลลัพธ์สุดท้ายของคีย์ พร้อมชื่อโมเดลที่ให้คำตอบและเวลาที่บันทึก"""
+    conn = _get_disk_cache_db()
+    with _disk_cache_lock:
+        conn.execute(
+            "INSERT OR REPLACE INTO lookup_cache (key, value, model, created) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), model, time.time()),
+        )
+        conn.commit()
+
+def _cons_key(iata_code: str, city_name: str, continent: str) -> str:
+    return f"cons:{iata_code}:{city_name}:{continent}"
+
+def _dist_key(destination_code: str) -> str:
+    return f"dist:{destination_code.upper()}"
+
+def _cached_generate(client, model: str, prompt: str, validate, config=None):
+    """
+    เรียก Gemini ผ่านแคชบนดิสก์ (คีย์คือ SHA-256 ของ model + prompt) และคืน response.text
+    validate(text) ของผู้เรียกกำหนดว่าคำตอบใช้ได้พอจะบันทึกลงแคชหรือไม่
+    """
+    return _disk_cache(
+        model, prompt,
+        lambda: _submit_gemini(partial(client.aio.models.generate_content, model=model, contents=prompt, config=config)).result().text or "",
+        validate,
+    )
+
+async def _pump_stream(client, model: str, prompt: str, config, chunk_queue):
+    """
+    เปิดสตรีมของ Gemini บน event loop ถาวร แล้วส่งข้อความแต่ละ chunk เข้า chunk_queue ให้ Thread ของ Streamlit parse ต่อ
+    ข้อผิดพลาดหลังส่ง chunk แรกไปแล้วจะไม่ถูกลองใหม่ (ผู้เรียกได้รับข้อมูลบางส่วนไปแล้ว)
+    """
+    sent = False
+    try:
+        stream = await client.aio.models.generate_content_stream(model=model, contents=prompt, config=config)
+        async for chunk in stream:
+            if chunk.text:
+                chunk_queue.put(chunk.text)
+                sent = True
+    except APIError as e:
+        if sent:
+            raise RuntimeError(f"สตรีมจาก Gemini ขาดกลางทาง: {e}") from e
+        raise
+
+def _iter_stream_chunks(client, model: str, prompt: str, config=None):
+    """
+    Generator ของข้อความแต่ละ chunk จาก _pump_stream ที่ส่งผ่าน _submit_gemini (Admission + ลองใหม่เมื่อเจอข้อผิดพลาดชั่วคราว)
+    """
+    chunk_queue = queue.Queue()
+    future = _submit_gemini(partial(_pump_stream, client, model, prompt, config, chunk_queue))
+    try:
+        while True:
+            # เมื่อ Future เสร็จแล้ว chunk ทั้งหมดอยู่ในคิวแล้ว คิวว่างจึงแปลว่าจบสตรีม
+            done = future.done()
+            try:
+                yield chunk_queue.get(block=not done, timeout=STREAM_POLL_SECONDS)
+            except queue.Empty:
+                if done:
+                    break
+        future.result()
+    finally:
+        future.cancel()
+
+def _stream_json_items(client, model: str, prompt: str, validate_items, config=None, cache_namespace=None, stat_kind=None):
+    """
+    สตรีมคำตอบที่เป็น JSON Array จาก Gemini และ yield แต่ละ item ทันทีที่ ijson parse ได้
+    คำตอบจะถูกบันทึกลงแคชบนดิสก์ (คีย์เดียวกับ _cached_generate) เฉพาะเมื่อ parse ได้ครบจนปิด Array
+    และ validate_items(รายการทั้งหมด) ผ่าน สตรีมที่ขาดกลางทางหรือผิดรูปแบบจะไม่ถูกเก็บ
+    cache_namespace (ค่าเริ่มต้นคือชื่อโมเดล) ใช้แยกแคชเมื่อส่วนคงที่ของ Prompt เปลี่ยน
+    stat_kind (ถ้ามี) ใช้บันทึกว่าคำตอบมาจากแคชบนดิสก์หรือจาก Gemini ในสถิติแคช
+    """
+    cache_namespace = cache_namespace or model
+    cached = _disk_cache_get(cache_namespace, prompt)
+    if cached is not None:
+        items = json.loads(cached)
+        if isinstance(items, list):
+            if stat_kind is not None:
+                _record_lookup(stat_kind, "disk")
+            yield from items
+            return
+
+    if stat_kind is not None:
+        _record_lookup(stat_kind, "gemini")
+    chunks = []
+    items = []
+    sink = ijson.sendable_list()
+    parser = ijson.items_coro(sink, "item", use_float=True)
+    for text in _iter_stream_chunks(client, model, prompt, config):
+        chunks.append(text)
+        parser.send(text.encode())
+        items.extend(sink)
+        yield from sink
+        del sink[:]
+    parser.close()
+    items.extend(sink)
+    yield from sink
+
+    if validate_items(items):
+        _disk_cache_put(cache_namespace, prompt, "".join(chunks))
+
+# Structured output: ให้ Gemini ตอบเป็น JSON ตาม Schema แทนข้อความอิสระ
+CONSISTENCY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "status": {"type": "string", "enum": ["PASS", "FAIL"]},
+        "reason": {"type": "string"},
+    },
+    "required": ["status"],
+}
+
+DISTANCE_SCHEMA = {
+    "type": "object",
+    "properties": {"distance_km": {"type": "integer"}},
+    "required": ["distance_km"],
+}
+
+ROUTE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "consistency": CONSISTENCY_SCHEMA,
+        "distance_km": {"type": "integer"},
+    },
+    "required": ["consistency", "distance_km"],
+}
+
+def _parse_consistency(raw_text: str):
+    """แปลงคำตอบการตรวจสอบเป็น "PASS" หรือ "FAIL: ..." (คืน None ถ้าตีความไม่ได้)"""
+    raw_text = raw_text.strip()
+    try:
+        result = json.loads(raw_text)
+    except json.JSONDecodeError:
+        # Fallback: ตอบกลับมาเป็นข้อความ 'PASS' / 'FAIL: ...' แบบเดิม
+        return raw_text if raw_text.startswith(("PASS", "FAIL")) else None
+
+    if not isinstance(result, dict):
+        return None
+    if result.get("status") == "PASS":
+        return "PASS"
+    if result.get("status") == "FAIL":
+        return f"FAIL: {result.get('reason', '')}"
+    return None
+
+def _gemini_consistency(client, iata_code: str, city_name: str, continent: str):
+    """ถาม Gemini ว่า IATA/City/Continent สอดคล้องกันหรือไม่ คืน (ผลการตรวจสอบ, โมเดลที่ตอบ)"""
     # ICAO/IATA consistency check - ให้ Gemini ตรวจสอบ IATA/City/Continent
     prompt = (
         f"ตรวจสอบความสอดคล้องของข้อมูลสนามบิน: IATA Code: {iata_code}, City: {city_name}, Continent: {continent}. "
-        "ถ้าข้อมูลสอดคล้อง (ตรงตามโลกจริง) ให้ตอบว่า 'PASS'. ถ้าไม่สอดคล้อง ให้ตอบว่า 'FAIL: [คำอธิบายว่าทำไมไม่ตรงกัน]'. "
+        "ถ้าข้อมูลสอดคล้อง (ตรงตามโลกจริง) ให้ตอบ status เป็น 'PASS'. ถ้าไม่สอดคล้อง ให้ตอบ status เป็น 'FAIL' พร้อม reason อธิบายว่าทำไมไม่ตรงกัน. "
         f"ถ้าระบุ Continent เป็น 'Domestic' ให้ถือว่าเมือง '{city_name}' อยู่ในประเทศไทย และทำการตรวจสอบ IATA Code ในประเทศไทย"
     )
-    
+
+    # ใช้โมเดลเล็กก่อน ถ้าตอบนอกเหนือ PASS/FAIL จึงถามซ้ำด้วยโมเดลหลัก
+    for model in (FAST_MODEL, ANALYSIS_MODEL):
+        raw_text = _cached_generate(
+            client, model, prompt,
+            validate=lambda text: _parse_consistency(text) is not None,
+            config={"response_mime_type": "application/json", "response_schema": CONSISTENCY_SCHEMA}
+        ).strip()
+
+        result = _parse_consistency(raw_text)
+        if result is not None:
+            return result, model
+    return raw_text, model
+
+def _validate_route_input(iata_code: str, city_name: str, continent: str):
+    """ตรวจรูปแบบ Input ในเครื่อง คืนข้อความ "FAIL: ..." เมื่อผิดรูปแบบ (ไม่เช่นนั้นคืน None)"""
+    if not _IATA_RE.match(iata_code):
+        return "FAIL: IATA Code ต้องเป็นตัวอักษรภาษาอังกฤษ 3 ตัว"
+    if not _CITY_RE.match(city_name.strip()):
+        return "FAIL: ชื่อเมืองต้องเป็นตัวอักษรอย่างน้อย 2 ตัว (ไม่มีตัวเลข)"
+    if continent not in CONTINENTS:
+        return "FAIL: กรุณาเลือกทวีปจากรายการ"
+    return None
+
+@st.cache_data(show_spinner="กำลังตรวจสอบความสอดคล้องของข้อมูล...")
+def _check_airport_consistency(iata_code: str, city_name: str, continent: str):
+    # Input ที่ผิดรูปแบบชัดเจน ไม่ต้องเรียก Gemini
+    invalid = _validate_route_input(iata_code, city_name, continent)
+    if invalid is not None:
+        return invalid
+
+    # ตรวจจากข้อมูลในเครื่องก่อน เรียก Gemini เฉพาะเมื่อไม่พบหรือไม่แน่ใจ
+    local_result = _local_consistency(iata_code, city_name, continent)
+    if local_result is not None:
+        _record_lookup("cons", "local")
+        return local_result
+
+    # ผลที่เคยได้จาก Gemini (เก็บบนดิสก์ 30 วัน) ใช้ได้ทันทีแม้รีสตาร์ตแอป
+    cache_key = _cons_key(iata_code, city_name, continent)
+    cached = _lookup_cache_get(cache_key, (FAST_MODEL, ANALYSIS_MODEL))
+    if cached is not None:
+        _record_lookup("cons", "disk")
+        return cached
+
+    _record_lookup("cons", "gemini")
+    client = _get_active_client()
+    if client is None:
+        return "API_ERROR: Gemini Client ไม่พร้อมใช้งาน"
+
     try:
-        response = client.models.generate_content(model='gemini-2.5-flash', contents=prompt)
-        return response.text.strip()
+        result, model = _gemini_consistency(client, iata_code, city_name, continent)
     except APIError as e:
         return f"API_ERROR: ไม่สามารถเรียกใช้ Gemini ได้: {e}"
     except Exception as e:
          return f"FAIL: เกิดข้อผิดพลาดที่ไม่ทราบสาเหตุ: {e}"
 
-@st.cache_data(show_spinner="กำลังคำนวณระยะทางบิน...")
-def get_flight_distance(destination_code: str):
-    client = _get_active_client()
-    if client is None:
-        return 0
+    if result == "PASS" or result.startswith("FAIL"):
+        _lookup_cache_put(cache_key, model, result)
+    return result
+
+# แหล่งที่มาของคำตอบที่ถูกบันทึกระหว่างการเรียกหนึ่งครั้ง (แยกตาม Thread ของแต่ละ Session)
+_lookup_trace = threading.local()
+
+def _record_lookup(kind: str, source: str):
+    """
+    บันทึกว่าคำตอบชนิด kind มาจากไหน ("local", "disk" หรือ "gemini") เรียกจากในฟังก์ชันที่ใช้
+    st.cache_data ได้ เพราะบันทึกเฉพาะตอนที่ฟังก์ชันทำงานจริง (ไม่เกิดเมื่อ st.cache_data ตอบจากหน่วยความจำ)
+    """
+    records = getattr(_lookup_trace, "records", None)
+    if records is not None:
+        records.append((kind, source))
+
+def _count_lookup(kind: str, hit: bool):
+    """นับสถิติแคชของ Session นี้ (hit = ตอบได้โดยไม่ต้องเรียก Gemini)"""
+    st.session_state.cache_stats[f"{kind}_{'hits' if hit else 'miss'}"] += 1
+
+def _counted(call, *kinds):
+    """
+    เรียก call() แล้วนับสถิติแคชจากแหล่งที่มาที่ถูกบันทึกไว้ระหว่างนั้น
+    kinds คือคำตอบที่นับ 1 ครั้งต่อการเรียก (ใช้บันทึกแรก ถ้าไม่มีบันทึกแปลว่า st.cache_data ตอบจากหน่วยความจำ = hit)
+    บันทึกชนิดอื่น (เช่น eval) นับทุกรายการ
+    """
+    _lookup_trace.records = []
+    try:
+        return call()
+    finally:
+        records, _lookup_trace.records = _lookup_trace.records, None
+        for kind in kinds:
+            _count_lookup(kind, next((src for k, src in records if k == kind), "memory") != "gemini")
+        for kind, src in records:
+            if kind not in kinds:
+                _count_lookup(kind, src != "gemini")
+
+def _parse_distance(raw_text: str) -> int:
+    """อ่านระยะทาง (กม.) จากคำตอบ Gemini คืน 0 เมื่ออ่านตัวเลขไม่ได้"""
+    raw_text = raw_text.strip()
+    try:
+        return int(json.loads(raw_text)["distance_km"])
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        pass
+
+    # Fallback: การทำความสะอาดข้อความด้วย Regex เมื่อ Gemini ไม่ได้ตอบเป็น JSON
+    match = _DIGITS_RE.search(raw_text)
+    return int(match.group(1).replace(",", "")) if match else 0
 
+def _gemini_distance(client, destination_code: str):
+    """ถาม Gemini หาระยะทางบินจาก BKK (กม.) คืน 0 เมื่ออ่านตัวเลขจากคำตอบไม่ได้"""
     destination_code_upper = destination_code.upper()
 
     prompt = (
@@ -99,22 +631,35 @@ def get_flight_distance(destination_code: str):
         f"ไปยังสนามบินปลายทางที่มี IATA code หรือ ICAO code คือ {destination_code_upper}. "
         "ให้แสดงผลเฉพาะ 'ระยะทางเป็นกิโลเมตร' เท่านั้น โดยเป็น **จำนวนเต็ม** และ **ไม่ใช่ค่าประมาณ**"
     )
-    
+
+    raw_text = _cached_generate(
+        client, FAST_MODEL, prompt,
+        validate=lambda text: _parse_distance(text) > 0,
+        config={"response_mime_type": "application/json", "response_schema": DISTANCE_SCHEMA}
+    )
+    return _parse_distance(raw_text)
+
+@st.cache_data(show_spinner="กำลังคำนวณระยะทางบิน...")
+def _get_flight_distance(destination_code: str):
+    # คำนวณจากพิกัดในเครื่อง (Haversine) เรียก Gemini เฉพาะเมื่อไม่พบสนามบิน
+    local_distance = _local_distance(destination_code)
+    if local_distance is not None:
+        _record_lookup("dist", "local")
+        return local_distance
+
+    cache_key = _dist_key(destination_code)
+    cached = _lookup_cache_get(cache_key, (FAST_MODEL,))
+    if cached is not None:
+        _record_lookup("dist", "disk")
+        return cached
+
+    _record_lookup("dist", "gemini")
+    client = _get_active_client()
+    if client is None:
+        return 0
+
     try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=prompt
-        )
-        raw_text = response.text.strip()
-        
-        # การทำความสะอาดข้อความด้วย Regex
-        numbers = re.findall(r'\d+', raw_text)
-        
-        if numbers:
-            return int(numbers[0]) 
-        else:
-            return 0 
-            
+        distance = _gemini_distance(client, destination_code)
     except APIError as e:
         st.error(f"API_ERROR: ไม่สามารถคำนวณระยะทางได้: {e}")
         return 0
@@ -122,89 +667,502 @@ def get_flight_distance(destination_code: str):
         st.error(f"Error during distance calculation: {e}")
         return 0
 
+    if distance > 0:
+        _lookup_cache_put(cache_key, FAST_MODEL, distance)
+    return distance
+
+
+def get_flight_distance(destination_code: str):
+    """ทำ IATA Code ให้เป็นรูปแบบมาตรฐานก่อนเข้าแคช"""
+    destination_code = destination_code.strip().upper()
+    return _counted(lambda: _get_flight_distance(destination_code), "dist")
+
+
+def _is_route_answer(raw_text: str) -> bool:
+    """คำตอบแบบรวม (ROUTE_SCHEMA) มี consistency.status เป็น PASS/FAIL หรือไม่"""
+    try:
+        return json.loads(raw_text)["consistency"]["status"] in ("PASS", "FAIL")
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return False
+
+@st.cache_data(show_spinner="กำลังตรวจสอบข้อมูลสนามบินและระยะทางบิน...")
+def _check_route(iata_code: str, city_name: str, continent: str):
+    """
+    ตรวจสอบความสอดคล้องและหาระยะทางบินพร้อมกัน คืน (ผลการตรวจสอบ, ระยะทาง กม.)
+    สนามบินที่มีในข้อมูลในเครื่องไม่ต้องเรียก Gemini เพื่อหาระยะทาง ส่วนสนามบินที่ไม่รู้จัก
+    จะถามทั้งสองเรื่องใน Request เดียว (ระยะทาง 0 หมายถึงยังไม่ทราบ)
+    """
+    invalid = _validate_route_input(iata_code, city_name, continent)
+    if invalid is not None:
+        return invalid, 0
+
+    local_distance = _local_distance(iata_code)
+    if local_distance is not None:
+        _record_lookup("dist", "local")
+        return _check_airport_consistency(iata_code, city_name, continent), local_distance
+
+    # ทั้งสองค่าเคยถูกบันทึกบนดิสก์แล้ว ไม่ต้องเรียก Gemini
+    cons_key = _cons_key(iata_code, city_name, continent)
+    dist_key = _dist_key(iata_code)
+    cached_result = _lookup_cache_get(cons_key, (FAST_MODEL, ANALYSIS_MODEL))
+    cached_distance = _lookup_cache_get(dist_key, (FAST_MODEL,))
+    if cached_result is not None and cached_distance is not None:
+        _record_lookup("cons", "disk")
+        _record_lookup("dist", "disk")
+        return cached_result, cached_distance
+
+    _record_lookup("cons", "gemini")
+    _record_lookup("dist", "gemini")
+    client = _get_active_client()
+    if client is None:
+        return "API_ERROR: Gemini Client ไม่พร้อมใช้งาน", 0
+
+    prompt = (
+        f"ตรวจสอบความสอดคล้องของข้อมูลสนามบิน: IATA Code: {iata_code}, City: {city_name}, Continent: {continent}. "
+        "ถ้าข้อมูลสอดคล้อง (ตรงตามโลกจริง) ให้ตอบ consistency.status เป็น 'PASS'. ถ้าไม่สอดคล้อง ให้ตอบ consistency.status เป็น 'FAIL' พร้อม consistency.reason อธิบายว่าทำไมไม่ตรงกัน. "
+        f"ถ้าระบุ Continent เป็น 'Domestic' ให้ถือว่าเมือง '{city_name}' อยู่ในประเทศไทย และทำการตรวจสอบ IATA Code ในประเทศไทย. "
+        f"และค้นหาระยะทางบิน (Great Circle Distance) จากสนามบิน BKK (Suvarnabhumi, Bangkok, Thailand) ไปยังสนามบิน {iata_code} "
+        "เป็นกิโลเมตร **จำนวนเต็ม** ใน distance_km"
+    )
+
+    try:
+        raw_text = _cached_generate(
+            client, FAST_MODEL, prompt,
+            validate=_is_route_answer,
+            config={"response_mime_type": "application/json", "response_schema": ROUTE_SCHEMA}
+        ).strip()
+        result = json.loads(raw_text)
+        status = result["consistency"].get("status")
+        distance = int(result.get("distance_km") or 0)
+    except APIError as e:
+        return f"API_ERROR: ไม่สามารถเรียกใช้ Gemini ได้: {e}", 0
+    except Exception:
+        # ตอบกลับมาไม่ตรง Schema: ใช้การตรวจสอบแบบแยก Request เดิม (ระยะทางจะหาในขั้นตอนถัดไป)
+        return _check_airport_consistency(iata_code, city_name, continent), 0
+
+    if distance > 0:
+        _lookup_cache_put(dist_key, FAST_MODEL, distance)
+    if status == "PASS":
+        consistency_result = "PASS"
+    elif status == "FAIL":
+        consistency_result = f"FAIL: {result['consistency'].get('reason', '')}"
+    else:
+        return _check_airport_consistency(iata_code, city_name, continent), distance
+    _lookup_cache_put(cons_key, FAST_MODEL, consistency_result)
+    return consistency_result, distance
+
+
+def check_route(iata_code: str, city_name: str, continent: str):
+    """ทำ Input ให้เป็นรูปแบบมาตรฐานก่อนเข้าแคช เพื่อให้ "hkt"/"HKT " หรือ "phuket"/"Phuket" ใช้ผลเดียวกัน"""
+    iata_code, city_name = iata_code.strip().upper(), city_name.strip().title()
+    # Input ที่ผิดรูปแบบไม่ได้ค้นหาอะไร จึงไม่นับในสถิติ
+    kinds = ("cons", "dist") if _validate_route_input(iata_code, city_name, continent) is None else ()
+    return _counted(lambda: _check_route(iata_code, city_name, continent), *kinds)
 
 # --------------------------------------------------------------------------------------
 # ********** ฟังก์ชันที่ใช้ Step-by-Step Generation (ปรับปรุง Prompt 7, 8, 9) **********
 # --------------------------------------------------------------------------------------
 
-def generate_aircraft_data(client, aircraft_model, distance_km, destination_code, destination_city):
+class AircraftEval(BaseModel):
     """
-    ฟังก์ชันย่อย: ให้ Gemini คำนวณข้อมูล 11 คอลัมน์สำหรับเครื่องบินแต่ละรุ่นในรูปแบบ JSON
-    (ปรับปรุง Prompt สำหรับคอลัมน์ 7, 8, 9 ให้สอดคล้อง)
+    ข้อมูล 11 องค์ประกอบของเครื่องบินหนึ่งรุ่น (เรียงตาม EVAL_COLUMNS) ใช้เป็น response_schema
+    ให้ Gemini บังคับรูปแบบคำตอบฝั่ง Server แทนการขอรายการ 11 องค์ประกอบใน Prompt
     """
-    aircraft_info = AIRCRAFT_DATA.get(aircraft_model, {})
-    
-    if distance_km > aircraft_info.get("range_km", 0):
-        return [
-            aircraft_model, aircraft_info.get("range_km", "N/A"), 
-            f'{aircraft_info.get("eco", 0)}/{aircraft_info.get("bc", 0)}/{aircraft_info.get("first", 0)}',
-            aircraft_info.get("fuel_cost", "N/A"), "N/A/N/A", "N/A/N/A", 0, "N/A", "N/A", 0.0,
-            f"เครื่องบินรุ่นนี้ ({aircraft_model}) มีพิสัยการบินไม่เพียงพอ ({aircraft_info.get('range_km', 0)} กม.) ที่จะบินตรงในเส้นทางนี้ ({distance_km} กม.) จึงได้คะแนน 0.0 ดาว"
-        ]
+    name: str = Field(description="ชื่อรุ่นเครื่องบิน")
+    range_km: int = Field(description="พิสัยการบิน (กิโลเมตร)")
+    seats: str = Field(description="จำนวนที่นั่ง (eco/bc/first)")
+    fuel: int = Field(description="อัตราสิ้นเปลือง (usd/hr)")
+    pax_out: str = Field(description="คาดการณ์ผู้โดยสารขาไปต่อสัปดาห์ (eco/bc/first)")
+    pax_in: str = Field(description="คาดการณ์ผู้โดยสารขากลับต่อสัปดาห์ (eco/bc/first)")
+    freq: int = Field(description="ความถี่เที่ยวบิน (ไป+กลับ) ต่อสัปดาห์ที่เหมาะสม")
+    dep_bkk: str = Field(description="เวลา Departure จาก BKK ที่เหมาะสม ในรูปแบบ HH:MMน., HH:MMน., ... โดยจำนวนเวลาต้องเท่ากับ freq")
+    dep_ret: str = Field(description="เวลา Departure จากปลายทางที่เหมาะสม ในรูปแบบ HH:MMน., HH:MMน., ... โดยจำนวนเวลาต้องเท่ากับ freq")
+    score: float = Field(ge=0, le=5, description="ความเหมาะสม เช่น 4.5, 3.0 (ห้ามใช้ 0.0 ถ้าบินถึง)")
+    summary: str = Field(description="สรุปสาเหตุ 50-100 คำ ภาษาไทย ห้ามมีเครื่องหมายจุลภาค")
+
+    def to_row(self):
+        """แปลงเป็นแถวข้อมูลตามลำดับ EVAL_COLUMNS"""
+        return list(self.model_dump().values())
+
+# ส่วนคงที่ของ Prompt ประเมินเครื่องบิน (ใช้ซ้ำทุก Request) ส่งเป็น system_instruction
+# เพื่อให้แต่ละ Request มีเฉพาะข้อมูลเส้นทาง/รุ่นเครื่องบินใน contents
+AIRCRAFT_SYSTEM_INSTRUCTION = """
+    คุณเป็นผู้เชี่ยวชาญด้านการวางแผนเส้นทางบินของสายการบินที่มีฐานที่ BKK (Suvarnabhumi, Bangkok, Thailand)
+    ข้อมูลเครื่องบินแต่ละรุ่นอยู่ท้ายคำสั่งนี้ (eco/bc/first = จำนวนที่นั่ง, fuel_cost = อัตราสิ้นเปลือง USD/hr, range_km = พิสัยการบิน กม.)
+
+    ตอบเป็น JSON ตาม Schema ที่กำหนด (คำอธิบายของแต่ละฟิลด์อยู่ใน Schema)"""
+
+AIRCRAFT_DATA_JSON = json.dumps(AIRCRAFT_DATA)
+AIRCRAFT_SYSTEM_PROMPT = f"{AIRCRAFT_SYSTEM_INSTRUCTION}\n    ข้อมูลเครื่องบิน: {AIRCRAFT_DATA_JSON}"
+
+# Namespace ของแคชบนดิสก์สำหรับผลประเมินเครื่องบิน: รวม hash ของส่วนคงที่ไว้ด้วย
+# เพราะคีย์แคชคือ Prompt รายเส้นทาง แก้ AIRCRAFT_DATA หรือคำสั่งแล้วต้องไม่ได้ผลเก่าคืนมา
+AIRCRAFT_CACHE_NAMESPACE = f"{ANALYSIS_MODEL}:{hashlib.sha256(AIRCRAFT_SYSTEM_PROMPT.encode()).hexdigest()[:16]}"
+
+def _aircraft_config(**config):
+    """Config สำหรับ Request ประเมินเครื่องบิน: แนบส่วนคงที่เป็น system_instruction"""
+    config["system_instruction"] = AIRCRAFT_SYSTEM_PROMPT
+    return config
+
+def _out_of_range_row(aircraft_model, distance_km):
+    """สร้างแถวข้อมูล 0.0 ดาวสำหรับรุ่นที่พิสัยการบินไม่พอ โดยไม่ต้องเรียก Gemini"""
+    info = AIRCRAFT_DATA[aircraft_model]
+    range_km, eco, bc, first, fuel_cost = info["range_km"], info["eco"], info["bc"], info["first"], info["fuel_cost"]
+    return [
+        aircraft_model, range_km, f"{eco}/{bc}/{first}",
+        fuel_cost, "N/A/N/A", "N/A/N/A", 0, "N/A", "N/A", 0.0,
+        f"เครื่องบินรุ่นนี้ ({aircraft_model}) มีพิสัยการบินไม่เพียงพอ ({range_km} กม.) ที่จะบินตรงในเส้นทางนี้ ({distance_km} กม.) จึงได้คะแนน 0.0 ดาว"
+    ]
+
+def _aircraft_prompt(aircraft_model, distance_km, destination_code, destination_city):
+    """Prompt สำหรับประเมินเครื่องบินหนึ่งรุ่น (ใช้ทั้งการเรียกปกติและ Batch Mode)"""
+    return f"""
+    สำหรับเส้นทาง BKK ไป {destination_city} ({destination_code}) ระยะทาง {distance_km} กม.
+    วิเคราะห์และคำนวณข้อมูลสำหรับเครื่องบินรุ่น {aircraft_model}
+    ส่งคืน JSON Object ของรุ่นนี้ตาม Schema"""
+
+def _parse_aircraft_row(raw_text):
+    """แปลงข้อความ JSON ที่ Gemini ส่งคืน (ตาม AircraftEval) เป็นแถวข้อมูล 11 องค์ประกอบ (ValidationError ถ้าโครงสร้างไม่ถูกต้อง)"""
+    return AircraftEval.model_validate_json(raw_text).to_row()
+
+def _is_aircraft_item(item, schema=AircraftEval) -> bool:
+    try:
+        schema.model_validate(item)
+    except ValidationError:
+        return False
+    return True
+
+def _aircraft_batch_schema(aircraft_models):
+    """AircraftEval ที่จำกัด name ให้เป็นหนึ่งในรุ่นที่ขอ (enum) สำหรับ Request รวมหลายรุ่น"""
+    return create_model(
+        "AircraftEvalBatch",
+        __base__=AircraftEval,
+        name=(Literal[tuple(aircraft_models)], Field(description="ชื่อรุ่นเครื่องบิน (ต้องเป็นหนึ่งในรุ่นที่ขอ)")),
+    )
+
+def _is_aircraft_batch(items, aircraft_models, schema) -> bool:
+    """คำตอบรวมมีครบทุกรุ่นที่ขอ รุ่นละหนึ่งแถว และทุกแถวถูกต้องตาม schema หรือไม่"""
+    names = [item.get("name") if isinstance(item, dict) else None for item in items]
+    return (
+        len(names) == len(aircraft_models)
+        and set(names) == set(aircraft_models)
+        and all(_is_aircraft_item(item, schema) for item in items)
+    )
+
+def _invalid_row(aircraft_model, e: ValidationError):
+    st.warning(f"Gemini response structure incorrect for {aircraft_model}: {e.error_count()} error(s)")
+    return [aircraft_model] + ["N/A"] * 8 + [1.0] + [f"โครงสร้างข้อมูลที่ Gemini ส่งคืนไม่ถูกต้อง ({e.error_count()} ฟิลด์)"]
+
+def _aircraft_error_row(aircraft_model, e):
+    st.error(f"Error generating data for {aircraft_model}: {e}")
+    return [aircraft_model] + ["N/A"] * 8 + [1.0] + [f"เกิดข้อผิดพลาดในการเรียกใช้ API สำหรับเครื่องบินรุ่นนี้: {str(e)[:50]}"]
+
+def _row_from_text(aircraft_model, raw_text):
+    try:
+        return _parse_aircraft_row(raw_text)
+    except ValidationError as e:
+        return _invalid_row(aircraft_model, e)
+    except Exception as e:
+        return _aircraft_error_row(aircraft_model, e)
+
+async def generate_aircraft_data(client, prompt, config, received_tokens=None, key=None):
+    """
+    ฟังก์ชันย่อย: ให้ Gemini คำนวณข้อมูล 11 คอลัมน์สำหรับเครื่องบินหนึ่งรุ่นแบบสตรีม คืนข้อความ JSON ที่ได้
+    ระหว่างรับ จะบันทึกจำนวน Token ที่ได้รับแล้วลงใน received_tokens[key] ให้ Script thread แสดงความคืบหน้า
+    (รันบน event loop ถาวร จึงไม่แตะ st.* การแปลงผลและแสดงข้อผิดพลาดทำใน Script thread)
+    """
+    chunks = []
+    stream = await client.aio.models.generate_content_stream(model=ANALYSIS_MODEL, contents=prompt, config=config)
+    async for chunk in stream:
+        if chunk.text:
+            chunks.append(chunk.text)
+        if received_tokens is not None and chunk.usage_metadata is not None:
+            received_tokens[key] = chunk.usage_metadata.candidates_token_count or 0
+    return "".join(chunks)
+
+
+def _generate_each_aircraft_data(client, aircraft_models, distance_km, destination_code, destination_city):
+    """
+    เรียก generate_aircraft_data สำหรับหลายรุ่นพร้อมกัน (asyncio) เป็น generator ที่ yield (รุ่น, แถวข้อมูล)
+    ทันทีที่แต่ละรุ่นเสร็จ เพื่อให้ผู้เรียกอัปเดต progress bar ได้ทีละรุ่น
+    """
+    config = _aircraft_config(response_mime_type="application/json", response_schema=AircraftEval)
+    prompts = {m: _aircraft_prompt(m, distance_km, destination_code, destination_city) for m in aircraft_models}
+
+    futures = {}
+    received_tokens = {}
+    for model in aircraft_models:
+        cached = _disk_cache_get(AIRCRAFT_CACHE_NAMESPACE, prompts[model])
+        _record_lookup("eval", "gemini" if cached is None else "disk")
+        if cached is not None:
+            yield model, _row_from_text(model, cached)
+        else:
+            make_call = partial(generate_aircraft_data, client, prompts[model], config, received_tokens, model)
+            futures[_submit_gemini(make_call)] = model
+
+    status = st.empty()
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=STREAM_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                model = futures[future]
+                try:
+                    raw_text = future.result()
+                    row = _parse_aircraft_row(raw_text)
+                except ValidationError as e:
+                    yield model, _invalid_row(model, e)
+                    continue
+                except Exception as e:
+                    yield model, _aircraft_error_row(model, e)
+                    continue
+                _disk_cache_put(AIRCRAFT_CACHE_NAMESPACE, prompts[model], raw_text)
+                yield model, row
+            if pending:
+                status.caption(f"📡 กำลังรับข้อมูลจาก Gemini อีก {len(pending)} รุ่น ({sum(received_tokens.values()):,} tokens)")
+    finally:
+        status.empty()
+        for future in futures:
+            future.cancel()
+
+
+def generate_all_aircraft_data(client, aircraft_models, distance_km, destination_code, destination_city):
+    """
+    ให้ Gemini ประเมินเครื่องบินหลายรุ่น (เฉพาะรุ่นที่บินถึง) ใน Request เดียว
+    (JSON Array ของ AircraftEval) เป็น generator ที่ yield (รุ่น, แถวข้อมูล) ทันทีที่ได้รับ
+    รุ่นที่มีในแคชบนดิสก์รายรุ่นแล้วจะไม่ถูกถามซ้ำ และแถวที่ถูกต้องจากคำตอบรวมจะถูกเก็บลงแคชรายรุ่นด้วย
+    """
+    prompts = {m: _aircraft_prompt(m, distance_km, destination_code, destination_city) for m in aircraft_models}
+
+    pending = []
+    for model in aircraft_models:
+        cached = _disk_cache_get(AIRCRAFT_CACHE_NAMESPACE, prompts[model])
+        if cached is None:
+            pending.append(model)
+        else:
+            _record_lookup("eval", "disk")
+            yield model, _row_from_text(model, cached)
+
+    if len(pending) <= 1:
+        # เหลือรุ่นเดียว (เช่นการถามใหม่รุ่นที่ผิดพลาด) ใช้ Request รายรุ่นซึ่งมีคีย์แคชรายรุ่นอยู่แล้ว
+        yield from _generate_each_aircraft_data(client, pending, distance_km, destination_code, destination_city)
+        return
+    aircraft_models = pending
 
     prompt = f"""
     สำหรับเส้นทาง BKK ไป {destination_city} ({destination_code}) ระยะทาง {distance_km} กม.
-    วิเคราะห์และคำนวณข้อมูลสำหรับเครื่องบินรุ่น {aircraft_model} ({aircraft_info}).
-
-    ข้อมูลที่ต้องส่งคืน **ต้อง** เป็นรายการ (List) ที่มี **11 องค์ประกอบ** เรียงตามลำดับนี้:
-    1. ชื่อรุ่นเครื่องบิน (String)
-    2. พิสัยการบิน (กิโลเมตร) (Integer)
-    3. จำนวนที่นั่ง (eco/bc/first) (String)
-    4. อัตราสิ้นเปลือง (usd/hr) (Integer)
-    5. คาดการณ์ผู้โดยสารขาไปต่อสัปดาห์ (eco/bc/first) (String)
-    6. คาดการณ์ผู้โดยสารขากลับต่อสัปดาห์ (eco/bc/first) (String)
-    7. ความถี่เที่ยวบิน (ไป+กลับ) ต่อสัปดาห์ที่เหมาะสม (Integer)
-    8. เวลา Departure จาก BKK ที่เหมาะสม (String, ในรูปแบบ HH:MMน., HH:MMน., ... โดยจำนวนเวลาในรายการต้องเท่ากับความถี่ในข้อ 7)
-    9. เวลา Departure จากปลายทางที่เหมาะสม (String, ในรูปแบบ HH:MMน., HH:MMน., ... โดยจำนวนเวลาในรายการต้องเท่ากับความถี่ในข้อ 7)
-    10. ความเหมาะสม (Float, เช่น 4.5, 3.0, ห้ามใช้ 0.0 ถ้าบินถึง)
-    11. สรุปสาเหตุ (String, 50-100 คำ ภาษาไทย, ห้ามมีเครื่องหมายจุลภาค)
+    วิเคราะห์และคำนวณข้อมูลสำหรับเครื่องบินแต่ละรุ่นต่อไปนี้: {", ".join(aircraft_models)}
+    ส่งคืนเป็น JSON Array ของ Object ตาม Schema จำนวน **{len(aircraft_models)} รายการ** เรียงตามลำดับรุ่นด้านบน"""
+
+    # รับผลแบบสตรีม: จับคู่แต่ละแถวกับรุ่นจาก name (ไม่ใช้ลำดับใน Array) แล้วส่งออกไปทันทีที่ parse ได้
+    schema = _aircraft_batch_schema(aircraft_models)
+    received = {}
+    duplicated = set()
+    try:
+        for item in _stream_json_items(
+            client, ANALYSIS_MODEL, prompt,
+            validate_items=lambda items: _is_aircraft_batch(items, aircraft_models, schema),
+            config=_aircraft_config(response_mime_type="application/json", response_schema=list[schema]),
+            cache_namespace=AIRCRAFT_CACHE_NAMESPACE,
+            stat_kind="eval",
+        ):
+            try:
+                row = schema.model_validate(item).to_row()
+            except ValidationError:
+                continue
+            model = row[0]
+            if model in received:
+                duplicated.add(model)
+                continue
+            received[model] = item
+            yield model, row
+    except Exception as e:
+        st.warning(f"Batched Gemini request failed, falling back to per-model requests: {e}")
+
+    # เก็บแถวที่ถูกต้องลงแคชรายรุ่น แม้คำตอบรวมจะไม่ครบ (การถามใหม่ครั้งหน้าจะถามเฉพาะรุ่นที่ยังขาด)
+    for model, item in received.items():
+        if model not in duplicated:
+            _disk_cache_put(AIRCRAFT_CACHE_NAMESPACE, prompts[model], json.dumps(item, ensure_ascii=False))
+
+    # รุ่นที่ไม่ได้รับ (ผิดรูปแบบ/ขาดหาย) หรือได้รับซ้ำ (ไม่แน่ใจว่าแถวไหนถูก) ให้ถามใหม่ทีละรุ่น (พร้อมกัน)
+    # แถวจากการถามใหม่จะแทนที่แถวเดิมของรุ่นที่ได้รับซ้ำ
+    retry = [m for m in aircraft_models if m not in received or m in duplicated]
+    if retry:
+        yield from _generate_each_aircraft_data(client, retry, distance_km, destination_code, destination_city)
+
+
+def generate_aircraft_data_batch(client, aircraft_models, distance_km, destination_code, destination_city):
+    """
+    Batch Mode: ส่ง Prompt รายรุ่นทั้งหมดเป็น Batch Job เดียวของ Gemini (ค่าใช้จ่ายถูกลง แต่รอนานกว่า)
+    เป็น generator ที่ yield (รุ่น, แถวข้อมูล) รุ่นที่มีในแคชบนดิสก์แล้วจะไม่ถูกส่งซ้ำ
+    ถ้า Job ล้มเหลวหรือเกินเวลา จะถอยกลับไปเรียกแบบปกติทีละรุ่น
     """
+    prompts = {m: _aircraft_prompt(m, distance_km, destination_code, destination_city) for m in aircraft_models}
+
+    pending = []
+    for model in aircraft_models:
+        cached = _disk_cache_get(AIRCRAFT_CACHE_NAMESPACE, prompts[model])
+        _record_lookup("eval", "gemini" if cached is None else "disk")
+        if cached is None:
+            pending.append(model)
+        else:
+            yield model, _row_from_text(model, cached)
+
+    if not pending:
+        return
 
     try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=prompt,
-            config={"response_mime_type": "application/json"}
+        config = _aircraft_config(response_mime_type="application/json", response_schema=AircraftEval)
+        job = client.batches.create(
+            model=ANALYSIS_MODEL,
+            src=[
+                {
+                    "contents": [{"role": "user", "parts": [{"text": prompts[m]}]}],
+                    "config": config,
+                }
+                for m in pending
+            ],
+            config={"display_name": f"airline-eval-{destination_code}-{distance_km}"},
         )
-        data_list = json.loads(response.text)
-        
-        if isinstance(data_list, list) and len(data_list) == 11:
-            return data_list
-        else:
-            st.warning(f"Gemini response structure incorrect for {aircraft_model}: Length {len(data_list)}")
-            return [aircraft_model] + ["N/A"] * 9 + [1.0] + [f"โครงสร้างข้อมูลที่ Gemini ส่งคืนไม่ถูกต้อง (ความยาว {len(data_list)})"]
-            
+
+        status = st.empty()
+        deadline = time.time() + BATCH_TIMEOUT_SECONDS
+        while job.state.name not in BATCH_DONE_STATES:
+            if time.time() > deadline:
+                client.batches.cancel(name=job.name)
+                raise TimeoutError(f"Batch job {job.name} ใช้เวลานานเกิน {BATCH_TIMEOUT_SECONDS} วินาที")
+            status.info(f"⏳ Batch job {job.name}: {job.state.name}")
+            time.sleep(BATCH_POLL_SECONDS)
+            job = client.batches.get(name=job.name)
+        status.empty()
+
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"Batch job {job.name} จบด้วยสถานะ {job.state.name}")
+        responses = job.dest.inlined_responses
     except Exception as e:
-        st.error(f"Error generating data for {aircraft_model}: {e}")
-        return [aircraft_model] + ["N/A"] * 9 + [1.0] + [f"เกิดข้อผิดพลาดในการเรียกใช้ API สำหรับเครื่องบินรุ่นนี้: {str(e)[:50]}"]
+        st.warning(f"Batch job failed, falling back to per-model requests: {e}")
+        yield from _generate_each_aircraft_data(client, pending, distance_km, destination_code, destination_city)
+        return
+
+    # ผลลัพธ์ของ Inline Batch เรียงตามลำดับ Request ที่ส่งไป
+    for model, inlined in zip(pending, responses):
+        if inlined.error is not None or inlined.response is None:
+            yield model, _aircraft_error_row(model, inlined.error)
+            continue
+        raw_text = inlined.response.text
+        try:
+            row = _parse_aircraft_row(raw_text)
+        except ValidationError as e:
+            yield model, _invalid_row(model, e)
+            continue
+        except Exception as e:
+            yield model, _aircraft_error_row(model, e)
+            continue
+        _disk_cache_put(AIRCRAFT_CACHE_NAMESPACE, prompts[model], raw_text)
+        yield model, row
+
+    for model in pending[len(responses):]:
+        yield model, _aircraft_error_row(model, "ไม่พบผลลัพธ์ใน Batch job")
 
 
 @st.cache_data(show_spinner="กำลังคาดการณ์ Demand และประเมินความเหมาะสมของเครื่องบิน...")
-def get_aircraft_evaluation(distance_km: int, destination_code: str, destination_city: str):
+def get_aircraft_evaluation(distance_km: int, destination_code: str, destination_city: str, batch_mode: bool = False):
     """
-    2.2 & 2.3: ประเมินเครื่องบินโดยการเรียก Gemini ซ้ำๆ สำหรับแต่ละรุ่น
+    2.2 & 2.3: ประเมินเครื่องบินทุกรุ่น โดยเรียก Gemini แบบรวมใน Request เดียวเฉพาะรุ่นที่พิสัยการบินถึง
+    (หรือผ่าน Gemini Batch Mode เมื่อ batch_mode=True)
     """
     client = _get_active_client()
     if client is None:
         return None
     
-    all_data_rows = []
-    aircraft_models = list(AIRCRAFT_DATA.keys())
-    progress_bar = st.progress(0, text="กำลังประเมินเครื่องบิน 0/7 รุ่น...")
+    # แยกรุ่นที่พิสัยไม่พอออกก่อน ส่งเฉพาะรุ่นที่บินถึงให้ Gemini
+    in_range = AIRCRAFT_DF["range_km"].to_numpy() >= distance_km
+    viable = AIRCRAFT_DF.index[in_range].tolist()
+    unreachable = AIRCRAFT_DF.index[~in_range].tolist()
+
+    rows = {m: _out_of_range_row(m, distance_km) for m in unreachable}
+    if viable:
+        progress_bar = st.progress(0, text=f"กำลังประเมินเครื่องบิน 0/{len(viable)} รุ่น...")
+        generate_rows = generate_aircraft_data_batch if batch_mode else generate_all_aircraft_data
+        evaluated = set()
+        for model, row in generate_rows(client, viable, distance_km, destination_code, destination_city):
+            # รุ่นเดียวกันอาจถูกส่งมาอีกครั้ง (ถามใหม่) แถวหลังแทนที่แถวเดิม จึงนับความคืบหน้าตามจำนวนรุ่น
+            rows[model] = row
+            evaluated.add(model)
+            done = len(evaluated)
+            progress_bar.progress(done / len(viable), text=f"กำลังประเมินเครื่องบิน {done}/{len(viable)} รุ่น: {model}...")
+        progress_bar.empty()
 
-    for i, model in enumerate(aircraft_models):
-        progress_bar.progress((i + 1) / len(aircraft_models), text=f"กำลังประเมินเครื่องบิน {i+1}/{len(aircraft_models)} รุ่น: {model}...")
-        row = generate_aircraft_data(client, model, distance_km, destination_code, destination_city)
-        all_data_rows.append(row)
-        
-    progress_bar.empty()
+    all_data_rows = [rows[m] for m in AIRCRAFT_MODELS]
 
     if not all_data_rows:
         return None
 
-    df = pd.DataFrame(all_data_rows)
-    csv_string = df.to_csv(header=False, index=False)
-    return csv_string
+    # สร้าง DataFrame แล้วแปลงคอลัมน์ตัวเลข ("N/A" -> ค่าว่าง) ให้ Arrow แสดงผลได้โดยไม่ต้องแก้ชนิดข้อมูลทุกครั้ง
+    df = pd.DataFrame.from_records(all_data_rows, columns=EVAL_COLUMNS)
+    return df.assign(**{
+        column: pd.to_numeric(df[column], errors="coerce").astype(dtype) for column, dtype in EVAL_DTYPES.items()
+    })
+
+
+# ดาวเต็มตามจำนวน (0-5) สำหรับเลือกด้วย index แทนการคูณสตริงทีละแถว
+STAR_TABLE = np.array(["★" * n for n in range(6)])
+
+def format_stars(scores):
+    """แปลงคอลัมน์คะแนนความเหมาะสมเป็นดาวสำหรับแสดงผลทั้งคอลัมน์ในครั้งเดียว เช่น 4.5 -> ★★★★½ (4.5)"""
+    s = pd.to_numeric(scores, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    valid = ~np.isnan(s)
+    full = np.clip(np.where(valid, s, 0).astype(int), 0, len(STAR_TABLE) - 1)
+    frac = s - full
+    half = np.where((frac >= 0.25) & (frac < 0.75), "½", "")
+    formatted = np.char.add(np.char.add(STAR_TABLE[full], half), np.char.add(" (", np.char.add(np.char.mod("%.1f", s), ")")))
+    formatted = np.where(s == 0.0, "🚫 0.0 ดาว (บินไม่ถึง)", formatted)
+    return np.where(valid, formatted, "N/A")
+
+
+def _eval_df_key(route, distance_km):
+    """คีย์ของตารางประเมินใน session state ของเส้นทางที่ตรวจสอบแล้ว (IATA, เมือง, ทวีป) และระยะทาง"""
+    iata_code, city_name, continent = route
+    return f"eval_df::{iata_code}::{city_name}::{continent}::{distance_km}"
+
+def _has_error_rows(df) -> bool:
+    """ตารางมีแถวที่ Gemini ตอบผิดพลาด/ผิดรูปแบบ (พิสัยการบินเป็นค่าว่าง) หรือไม่"""
+    return df["พิสัยการบิน (กม.)"].isna().any()
+
+def _store_eval_df(eval_key, df):
+    """เก็บตารางประเมินใน session state โดยเก็บไว้ไม่เกิน EVAL_DF_CACHE_SIZE เส้นทางล่าสุด"""
+    eval_dfs = st.session_state.setdefault("eval_dfs", {})
+    eval_dfs.pop(eval_key, None)
+    eval_dfs[eval_key] = df
+    while len(eval_dfs) > EVAL_DF_CACHE_SIZE:
+        del eval_dfs[next(iter(eval_dfs))]
+
+
+def render_summary(evaluation_df, selected_model):
+    """4. แสดงผลสรุปของรุ่นเครื่องบินที่เลือก จาก DataFrame ที่เก็บไว้ใน session state"""
+    # ดึงข้อมูลจาก DataFrame ที่แคชไว้
+    if evaluation_df is not None:
+        try:
+            # ค่าว่างของแถวที่ผิดพลาดแสดงเป็น "N/A" เหมือนในตาราง
+            selected_data = evaluation_df[evaluation_df["ชื่อรุ่นเครื่องบิน"] == selected_model].iloc[0].fillna("N/A")
+
+            # ดึงข้อมูลดาวที่ถูกจัดรูปแบบแล้ว
+            selected_star = selected_data['ความเหมาะสม (ดาว) Format']
+
+            st.subheader("4. สรุปผลการเลือกเครื่องบิน")
+            st.success(f"✅ รุ่นเครื่องบินที่เลือกคือ **{selected_model}**")
+
+            st.markdown(f"""
+            * **ความเหมาะสม:** **{selected_star}**
+            * **พิสัยการบิน:** {selected_data['พิสัยการบิน (กม.)']} กม.
+            * **ความถี่ที่แนะนำ:** {selected_data['ความถี่เที่ยวบิน (ไป+กลับ)/สัปดาห์']} เที่ยวบินต่อสัปดาห์
+            * **เวลา Departure BKK:** {selected_data['เวลา Departure จาก BKK']}
+            * **เวลา Departure ปลายทาง:** {selected_data['เวลา Departure จากปลายทาง']}
+            * **สรุปสาเหตุ:** {selected_data['สรุปสาเหตุ']}
+            """)
+
+        except IndexError:
+            st.error(f"❌ ไม่พบข้อมูลสำหรับรุ่นเครื่องบินที่เลือก: {selected_model}")
 
 
 # --------------------------------------------------------------------------------------
@@ -246,31 +1204,36 @@ with col3:
         key="continent_select"
     )
 
+summary_rendered = False
+
 # กำหนด Session State เริ่มต้น
 if 'data_consistent' not in st.session_state:
     st.session_state.data_consistent = False
 if 'distance_km' not in st.session_state:
     st.session_state.distance_km = 0
-if 'evaluation_df' not in st.session_state:
-    st.session_state.evaluation_df = None
 if 'selected_aircraft' not in st.session_state:
     st.session_state.selected_aircraft = None
+if 'verified_route' not in st.session_state:
+    st.session_state.verified_route = None
 
 # ปุ่มตรวจสอบความสอดคล้อง
 if st.button("🔎 ตรวจสอบข้อมูลสนามบิน", disabled=not is_gemini_ready or not (iata_code and city_name and continent)):
     
     st.session_state.distance_km = 0  
-    st.session_state.evaluation_df = None 
     st.session_state.data_consistent = False
     st.session_state.selected_aircraft = None
+    st.session_state.verified_route = None
     
     if is_gemini_ready:
         with st.spinner("กำลังตรวจสอบข้อมูลกับ Gemini..."):
-            consistency_result = check_airport_consistency(iata_code, city_name, continent)
+            # ตรวจสอบความสอดคล้องและหาระยะทางในคราวเดียว
+            consistency_result, st.session_state.distance_km = check_route(iata_code, city_name, continent)
 
         if consistency_result.startswith("PASS"):
             st.success("✅ ข้อมูลสนามบินสอดคล้อง! ดำเนินการขั้นตอนถัดไป")
             st.session_state.data_consistent = True
+            # ขั้นตอนถัดไปใช้เส้นทางที่ตรวจสอบแล้วนี้ ไม่ใช่ค่าใน Input ที่อาจถูกแก้ภายหลัง (รูปแบบเดียวกับ check_route)
+            st.session_state.verified_route = (iata_code.strip().upper(), city_name.strip().title(), continent)
         # (ส่วนการจัดการ Error เหมือนเดิม)
         elif consistency_result.startswith("FAIL"):
             st.session_state.data_consistent = False
@@ -287,69 +1250,55 @@ if st.button("🔎 ตรวจสอบข้อมูลสนามบิน"
 
 if st.session_state.data_consistent:
     st.header("2. การประเมินเส้นทางบินและรุ่นเครื่องบิน")
+    route = st.session_state.verified_route
+    route_iata, route_city, _ = route
 
     # 2.1 ค้นหาระยะทางบิน
     if st.session_state.distance_km == 0:
-        with st.spinner(f"กำลังค้นหาระยะทางบิน BKK ไป {iata_code}..."):
+        with st.spinner(f"กำลังค้นหาระยะทางบิน BKK ไป {route_iata}..."):
             # ใช้ IATA Code ในการค้นหาระยะทาง
-            distance = get_flight_distance(iata_code)
+            distance = get_flight_distance(route_iata)
             st.session_state.distance_km = distance
     else:
         distance = st.session_state.distance_km
 
     if distance > 0:
-        st.info(f"📏 **ระยะทางบิน (BKK -> {iata_code}):** **{distance:,} กิโลเมตร**")
+        st.info(f"📏 **ระยะทางบิน (BKK -> {route_iata}):** **{distance:,} กิโลเมตร**")
 
         # 2.2 & 2.3 การประเมินเครื่องบินและการแสดงผล
-        if st.session_state.evaluation_df is None:
+        # เก็บตารางแยกตามเส้นทาง: rerun ของเส้นทางเดิมดึงจาก session state ได้ทันที ไม่ต้องสร้าง DataFrame ใหม่
+        eval_key = _eval_df_key(route, distance)
+        evaluation_df = st.session_state.get("eval_dfs", {}).get(eval_key)
+        if evaluation_df is None:
             # ใช้ IATA Code ในการประเมิน
-            csv_result = get_aircraft_evaluation(distance, iata_code, city_name)
+            eval_args = (distance, route_iata, route_city, st.session_state.batch_mode)
+            df = _counted(lambda: get_aircraft_evaluation(*eval_args))
                 
-            if csv_result and not csv_result.startswith("API_ERROR"):
+            if df is not None:
+                # ทุกแถวถูกตรวจให้มีครบ 11 คอลัมน์ตั้งแต่ตอนสร้างแถวแล้ว จึงไม่ต้องตรวจรูปร่าง DataFrame ซ้ำ
                 try:
-                    df = pd.read_csv(io.StringIO(csv_result), header=None)
-                    
-                    if df.shape[1] == 11:
-                        df.columns = [
-                            "ชื่อรุ่นเครื่องบิน", "พิสัยการบิน (กม.)", "จำนวนที่นั่ง (eco/bc/first)", 
-                            "อัตราสิ้นเปลือง (USD/hr)", "คาดการณ์ผู้โดยสารขาไป (eco/bc/first)", 
-                            "คาดการณ์ผู้โดยสารขากลับ (eco/bc/first)", "ความถี่เที่ยวบิน (ไป+กลับ)/สัปดาห์", 
-                            "เวลา Departure จาก BKK", "เวลา Departure จากปลายทาง", 
-                            "ความเหมาะสม (ดาว)", "สรุปสาเหตุ"
-                        ]
-                        st.session_state.evaluation_df = df
-                    else:
-                        st.error(f"❌ Gemini ส่งข้อมูลกลับมาไม่ครบตามรูปแบบ (คาด 11 คอลัมน์ ได้ {df.shape[1]} คอลัมน์). โปรดลองอีกครั้ง")
+                    # คำนวณคอลัมน์ดาวที่จัดรูปแบบแล้วครั้งเดียว แทนการ apply ใหม่ทุกครั้งที่ Streamlit rerun
+                    evaluation_df = df.assign(
+                        **{"ความเหมาะสม (ดาว) Format": format_stars(df["ความเหมาะสม (ดาว)"])}
+                    )
                 except Exception as e:
                     st.error(f"❌ เกิดข้อผิดพลาดในการประมวลผลข้อมูลจาก Gemini: {e}")
 
-        if st.session_state.evaluation_df is not None:
+            if evaluation_df is not None:
+                # เก็บตารางไว้ทั้งที่มีแถวผิดพลาด (rerun จะไม่เรียก Gemini ซ้ำ) แต่ไม่ให้ Session อื่นใช้ผลที่ผิดพลาดจาก st.cache_data
+                _store_eval_df(eval_key, evaluation_df)
+                if _has_error_rows(evaluation_df):
+                    get_aircraft_evaluation.clear(*eval_args)
+        if evaluation_df is not None:
             st.subheader("ตารางสรุปการประเมินรุ่นเครื่องบิน")
-            
-            def format_star(score):
-                try:
-                    score = float(score)
-                except (ValueError, TypeError):
-                    return "N/A"
-                    
-                if score == 0.0:
-                    return "🚫 0.0 ดาว (บินไม่ถึง)"
-                full_stars = int(score)
-                half_star = "½" if score - full_stars >= 0.25 and score - full_stars < 0.75 else ""
-                stars = "★" * full_stars
-                return f"{stars}{half_star} ({score:.1f})"
-            
-            display_df = st.session_state.evaluation_df.copy()
-            display_df['ความเหมาะสม (ดาว) Format'] = display_df['ความเหมาะสม (ดาว)'].astype(str).apply(format_star)
+
+            # ถามใหม่เฉพาะรุ่นที่ผิดพลาด: รุ่นที่ได้ผลแล้วอยู่ในแคชบนดิสก์รายรุ่น จึงไม่ถูกถามซ้ำ
+            if _has_error_rows(evaluation_df) and st.button("🔁 ประเมินรุ่นที่ผิดพลาดอีกครั้ง", key="retry_failed_models"):
+                del st.session_state.eval_dfs[eval_key]
+                st.rerun()
             
             st.dataframe(
-                display_df[[
-                    "ชื่อรุ่นเครื่องบิน", "พิสัยการบิน (กม.)", "จำนวนที่นั่ง (eco/bc/first)", 
-                    "อัตราสิ้นเปลือง (USD/hr)", "คาดการณ์ผู้โดยสารขาไป (eco/bc/first)", 
-                    "คาดการณ์ผู้โดยสารขากลับ (eco/bc/first)", "ความถี่เที่ยวบิน (ไป+กลับ)/สัปดาห์", 
-                    "เวลา Departure จาก BKK", "เวลา Departure จากปลายทาง", 
-                    "ความเหมาะสม (ดาว) Format", "สรุปสาเหตุ"
-                ]],
+                evaluation_df[COLUMNS_TO_SHOW],
                 height=350,
                 use_container_width=True,
                 column_config={
@@ -370,11 +1319,11 @@ if st.session_state.data_consistent:
             st.subheader("3. เลือกรุ่นเครื่องบินที่ต้องการใช้")
             
             try:
-                available_aircraft = st.session_state.evaluation_df[
-                    st.session_state.evaluation_df['ความเหมาะสม (ดาว)'].astype(float) > 0.0
+                available_aircraft = evaluation_df[
+                    evaluation_df['ความเหมาะสม (ดาว)'].astype(float) > 0.0
                 ]["ชื่อรุ่นเครื่องบิน"].tolist()
             except (ValueError, TypeError):
-                 available_aircraft = st.session_state.evaluation_df["ชื่อรุ่นเครื่องบิน"].tolist()
+                 available_aircraft = evaluation_df["ชื่อรุ่นเครื่องบิน"].tolist()
             
             # เพิ่มตัวเลือกว่างถ้าไม่มีเครื่องบินที่เหมาะสม
             if available_aircraft:
@@ -388,54 +1337,26 @@ if st.session_state.data_consistent:
                 # ปุ่มยืนยันรุ่นเครื่องบิน
                 if st.button("✅ ยืนยันรุ่นเครื่องบินและคำนวณ", disabled=not aircraft_selection):
                     st.session_state.selected_aircraft = aircraft_selection
-                    # Re-run เพื่อแสดงผลสรุปในส่วนด้านล่าง
-                    st.rerun()
+                    # แสดงผลสรุปทันทีในรอบเดียวกัน ไม่ต้อง st.rerun() ทั้งสคริปต์
+                    render_summary(evaluation_df, aircraft_selection)
+                    summary_rendered = True
 
             elif available_aircraft:
                  st.error("🚨 ไม่มีรุ่นเครื่องบินใดในรายการที่สามารถบินในเส้นทางนี้ได้! (ทุกรุ่นได้ 0 ดาว หรือข้อมูลผิดพลาด)")
         else:
             st.warning("⚠️ ไม่สามารถแสดงตารางประเมินได้เนื่องจากเกิดข้อผิดพลาดในการรับข้อมูลจาก Gemini.")
     else:
-        st.error(f"❌ ไม่สามารถคำนวณระยะทางบินจริงจาก BKK ไป {iata_code} ได้ หรือระยะทางเป็น 0. โปรดตรวจสอบ IATA Code และลองอีกครั้ง")
+        st.error(f"❌ ไม่สามารถคำนวณระยะทางบินจริงจาก BKK ไป {route_iata} ได้ หรือระยะทางเป็น 0. โปรดตรวจสอบ IATA Code และลองอีกครั้ง")
 
 # --- 7. ส่วนแสดงผลสรุปหลังการเลือก (เพิ่มใหม่) ---
-if st.session_state.selected_aircraft:
-    selected_model = st.session_state.selected_aircraft
-    
-    # ดึงข้อมูลจาก DataFrame ที่แคชไว้
-    if st.session_state.evaluation_df is not None:
-        try:
-            selected_data = st.session_state.evaluation_df[
-                st.session_state.evaluation_df["ชื่อรุ่นเครื่องบิน"] == selected_model
-            ].iloc[0]
-            
-            # ดึงข้อมูลดาวที่ถูกจัดรูปแบบแล้ว
-            display_df = st.session_state.evaluation_df.copy()
-            def format_star(score): # ต้องนิยามซ้ำเพราะ st.rerun
-                try:
-                    score = float(score)
-                except (ValueError, TypeError):
-                    return "N/A"
-                if score == 0.0: return "🚫 0.0 ดาว (บินไม่ถึง)"
-                full_stars = int(score)
-                half_star = "½" if score - full_stars >= 0.25 and score - full_stars < 0.75 else ""
-                stars = "★" * full_stars
-                return f"{stars}{half_star} ({score:.1f})"
-
-            display_df['ความเหมาะสม (ดาว) Format'] = display_df['ความเหมาะสม (ดาว)'].astype(str).apply(format_star)
-            selected_star = display_df[display_df["ชื่อรุ่นเครื่องบิน"] == selected_model]['ความเหมาะสม (ดาว) Format'].iloc[0]
-            
-            st.subheader("4. สรุปผลการเลือกเครื่องบิน")
-            st.success(f"✅ รุ่นเครื่องบินที่เลือกคือ **{selected_model}**")
-            
-            st.markdown(f"""
-            * **ความเหมาะสม:** **{selected_star}**
-            * **พิสัยการบิน:** {selected_data['พิสัยการบิน (กม.)']} กม.
-            * **ความถี่ที่แนะนำ:** {selected_data['ความถี่เที่ยวบิน (ไป+กลับ)/สัปดาห์']} เที่ยวบินต่อสัปดาห์
-            * **เวลา Departure BKK:** {selected_data['เวลา Departure จาก BKK']}
-            * **เวลา Departure ปลายทาง:** {selected_data['เวลา Departure จากปลายทาง']}
-            * **สรุปสาเหตุ:** {selected_data['สรุปสาเหตุ']}
-            """)
+# กรณีผู้ใช้กลับมาที่ Session ที่เลือกเครื่องบินไว้แล้ว (ไม่ได้เพิ่งกดปุ่มยืนยันในรอบนี้)
+if st.session_state.selected_aircraft and st.session_state.verified_route and not summary_rendered:
+    render_summary(
+        st.session_state.get("eval_dfs", {}).get(
+            _eval_df_key(st.session_state.verified_route, st.session_state.distance_km)
+        ),
+        st.session_state.selected_aircraft,
+    )
 
-        except IndexError:
-            st.error(f"❌ ไม่พบข้อมูลสำหรับรุ่นเครื่องบินที่เลือก: {selected_model}")
\ No newline at end of file
+# --- 8. สถิติแคช (แสดงท้ายสคริปต์ เพื่อให้รวมการเรียกในรอบนี้แล้ว) ---
+st.sidebar.expander("📊 Cache stats").json(st.session_state.cache_stats)